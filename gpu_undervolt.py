@@ -14,6 +14,8 @@ Features
 """
 
 import argparse
+import asyncio
+import bisect
 import os
 import shlex
 import signal
@@ -21,16 +23,38 @@ import subprocess
 import sys
 import time
 from dataclasses import dataclass
+from shutil import which
+
+# Optional: NVML bindings (pynvml / nvidia-ml-py). When available we talk to
+# libnvidia-ml directly instead of forking nvidia-smi per poll, which is
+# orders of magnitude cheaper. Everything falls back to nvidia-smi if absent.
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+# Optional: DCGM bindings (datacenter-gpu-manager). DCGM samples telemetry in
+# the background, so the thermal guard can read a cached value instead of
+# issuing its own query, and gains throttle-reason bits as an early signal.
+try:
+    import pydcgm
+    import dcgm_structs
+    import dcgm_fields
+    import dcgmvalue
+except ImportError:
+    pydcgm = None
 
 # ---------- Version ----------
 VERSION = "1.0"
 
+# Thermal throttle-reason bits (same encoding in NVML and DCGM):
+# HW_SLOWDOWN | SW_THERMAL | HW_THERMAL
+THERMAL_THROTTLE_MASK = 0x8 | 0x20 | 0x40
+
 # ---------- Utilities ----------
 
-def run(cmd, check=True, capture=False, env=None):
-    """Run a shell command list safely."""
-    if isinstance(cmd, str):
-        cmd = shlex.split(cmd)
+def run(cmd: list[str], *, check=True, capture=False, env=None):
+    """Run a command argv (list only — never a shell string)."""
     if capture:
         res = subprocess.run(cmd, check=check, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env)
         return res.stdout.strip()
@@ -38,11 +62,6 @@ def run(cmd, check=True, capture=False, env=None):
         subprocess.run(cmd, check=check, env=env)
 
 
-def which(exe):
-    from shutil import which as _which
-    return _which(exe)
-
-
 def require_tool(name):
     if not which(name):
         sys.exit(f"ERROR: Required tool '{name}' not found in PATH.")
@@ -58,12 +77,42 @@ def log(msg, *, verbose=True):
         print(msg, flush=True)
 
 
-def now():
-    return time.time()
+def _nvml_field_value(fv):
+    """Extract the typed payload from an nvmlFieldValue_t union."""
+    vt = fv.valueType
+    if vt == pynvml.NVML_VALUE_TYPE_DOUBLE:
+        return fv.value.dVal
+    if vt == pynvml.NVML_VALUE_TYPE_UNSIGNED_LONG:
+        return fv.value.ulVal
+    if vt == pynvml.NVML_VALUE_TYPE_UNSIGNED_LONG_LONG:
+        return fv.value.ullVal
+    if vt == pynvml.NVML_VALUE_TYPE_SIGNED_LONG_LONG:
+        return fv.value.sllVal
+    return fv.value.uiVal
+
+
+def now_ns():
+    # Monotonic, immune to NTP steps; integer ns so hysteresis compares ints.
+    return time.monotonic_ns()
 
 
 # ---------- NVIDIA Controls ----------
 
+class GpuInfo:
+    """
+    Reusable telemetry sample. __slots__ makes each field access a fixed
+    offset lookup (no per-poll dict hashing) and keeps the object small.
+    """
+    __slots__ = ("clocks_gr", "temp", "power", "util", "pstate")
+
+    def __init__(self):
+        self.clocks_gr = 0
+        self.temp = 0
+        self.power = 0.0
+        self.util = 0
+        self.pstate = ""
+
+
 @dataclass
 class NvCtl:
     index: int
@@ -72,97 +121,408 @@ class NvCtl:
     dry_run: bool = False
     verbose: bool = True
 
+    def __post_init__(self):
+        # NVML handle (one per NvCtl, cached). Skipped in dry-run so every
+        # would-be action goes through the loggable nvidia-smi path.
+        self._h = None
+        self._pl_min = None
+        self._pl_max = None
+        # Resolve tool paths once; which() stats every PATH entry per call.
+        self._nvsmi_path = which("nvidia-smi") or "nvidia-smi"
+        self._nvset_path = which("nvidia-settings")
+        # Pre-built argv prefixes; avoids re-stringifying the index per call.
+        self._smi_prefix = [self._nvsmi_path, "-i", str(self.index)]
+        self._lgc_sh_prefix = f"{shlex.quote(self._nvsmi_path)} -i {self.index} -lgc"
+        # nvidia-settings env built once instead of copying os.environ per call.
+        self._nvset_env = {**os.environ, "DISPLAY": self.display} if (self.use_offsets and self.display) else None
+        if pynvml is not None and not self.dry_run:
+            try:
+                pynvml.nvmlInit()
+                self._h = pynvml.nvmlDeviceGetHandleByIndex(self.index)
+            except pynvml.NVMLError as e:
+                log(f"WARNING: NVML init failed ({e}); falling back to nvidia-smi.", verbose=self.verbose)
+                self._h = None
+        # Batched field reads: one C call per poll instead of five. Reused
+        # sample object avoids per-poll allocations in the daemon.
+        self._info = GpuInfo()
+        self._fi_ids = None
+        if self._h is not None:
+            try:
+                self._fi_ids = [pynvml.NVML_FI_DEV_CLOCK_GRAPHICS,
+                                pynvml.NVML_FI_DEV_TEMPERATURE_GPU,
+                                pynvml.NVML_FI_DEV_POWER_INSTANT,
+                                pynvml.NVML_FI_DEV_GPU_UTIL,
+                                pynvml.NVML_FI_DEV_PSTATE]
+            except AttributeError:
+                self._fi_ids = None  # bindings too old for these field IDs
+        self._supported = None   # memoized supported-clock grid
+        self._dcgm = None
+        self._dcgm_group = None
+        self._dcgm_fg = None
+        if pydcgm is not None and not self.dry_run:
+            self._dcgm_setup()
+        self._event_set = None
+
+    def _dcgm_setup(self):
+        """Attach to DCGM and watch temp + throttle reasons for this GPU."""
+        try:
+            self._dcgm = pydcgm.DcgmHandle(opMode=dcgm_structs.DCGM_OPERATION_MODE_AUTO)
+            self._dcgm_group = pydcgm.DcgmGroup(self._dcgm, groupName=f"gpu_undervolt_{self.index}",
+                                                groupType=dcgm_structs.DCGM_GROUP_EMPTY)
+            self._dcgm_group.AddGpu(self.index)
+            self._dcgm_fg = pydcgm.DcgmFieldGroup(self._dcgm, name=f"gpu_undervolt_fg_{self.index}",
+                                                  fieldIds=[dcgm_fields.DCGM_FI_DEV_GPU_TEMP,
+                                                            dcgm_fields.DCGM_FI_DEV_CLOCK_THROTTLE_REASONS])
+            # 1s sampling, keep 1h; DCGM does the collection in the background.
+            self._dcgm_group.samples.WatchFields(self._dcgm_fg, 1000000, 3600.0, 0)
+        except Exception as e:
+            log(f"WARNING: DCGM unavailable ({e}); thermal guard will query directly.", verbose=self.verbose)
+            self._dcgm = None
+
+    def query_thermal(self):
+        """
+        Return (temp_c, throttle_reasons) for the thermal guard. Prefers
+        DCGM's cached samples (no device round-trip); falls back to
+        query_basic. throttle_reasons is 0 when unknown; temp is None on
+        failure.
+        """
+        if self._dcgm is not None:
+            try:
+                data = self._dcgm_group.samples.GetLatest(self._dcgm_fg).values[self.index]
+                temp = data[dcgm_fields.DCGM_FI_DEV_GPU_TEMP].values[-1].value
+                reasons = data[dcgm_fields.DCGM_FI_DEV_CLOCK_THROTTLE_REASONS].values[-1].value
+                # DCGM signals "no sample yet"/"not supported" with blank
+                # int64 sentinels, which are plain Python ints — treat them
+                # as unknown, never as real readings.
+                if isinstance(temp, int) and not dcgmvalue.DCGM_INT64_IS_BLANK(temp):
+                    if not isinstance(reasons, int) or dcgmvalue.DCGM_INT64_IS_BLANK(reasons):
+                        reasons = 0
+                    return temp, int(reasons)
+            except Exception:
+                pass
+        info = self.query_basic()
+        return (info.temp, 0) if info else (None, 0)
+
+    def watch_events(self):
+        """
+        Register for NVML clock/pstate change events on this GPU. Returns
+        True if the event set is live (NVML in use, GPU and driver support
+        the event types); safe to call more than once.
+        """
+        if self._h is None:
+            return False
+        if self._event_set is not None:
+            return True
+        try:
+            mask = pynvml.nvmlEventTypeClock | pynvml.nvmlEventTypePState
+            mask &= pynvml.nvmlDeviceGetSupportedEventTypes(self._h)
+            if not mask:
+                return False
+            self._event_set = pynvml.nvmlEventSetCreate()
+            pynvml.nvmlDeviceRegisterEvents(self._h, mask, self._event_set)
+            return True
+        except (pynvml.NVMLError, AttributeError):
+            self._event_set = None
+            return False
+
+    def wait_event(self, timeout_ms):
+        """
+        Block until a registered event fires or timeout_ms elapses. Returns
+        True on an event, False on timeout. Any other NVML error (GPU lost,
+        driver reload) tears the event set down — events_active goes False
+        and callers must revert to plain sleep ticks. Blocking: callers on
+        an event loop should run this in a thread.
+        """
+        wait = getattr(pynvml, "nvmlEventSetWait_v2", None) or pynvml.nvmlEventSetWait
+        try:
+            wait(self._event_set, int(timeout_ms))
+            return True
+        except pynvml.NVMLError_Timeout:
+            return False
+        except pynvml.NVMLError:
+            # Persistent failure: returning instantly here forever would let
+            # an event-driven caller busy-spin, so stop event delivery.
+            try:
+                pynvml.nvmlEventSetFree(self._event_set)
+            except pynvml.NVMLError:
+                pass
+            self._event_set = None
+            return False
+
+    @property
+    def events_active(self):
+        return self._event_set is not None
+
+    @property
+    def using_nvml(self):
+        return self._h is not None
+
+    def close(self):
+        """Release the NVML/DCGM contexts (no-op on the nvidia-smi fallback path)."""
+        if self._event_set is not None:
+            try:
+                pynvml.nvmlEventSetFree(self._event_set)
+            except pynvml.NVMLError:
+                pass
+            self._event_set = None
+        if self._dcgm is not None:
+            try:
+                self._dcgm.Shutdown()
+            except Exception:
+                pass
+            self._dcgm = None
+        if self._h is not None:
+            self._h = None
+            try:
+                pynvml.nvmlShutdown()
+            except pynvml.NVMLError:
+                pass
+
     def _nvidia_smi(self, args, capture=False):
-        cmd = ["nvidia-smi", "-i", str(self.index)] + args
+        cmd = self._smi_prefix + args
         if self.dry_run:
             log(f"[dry-run] {' '.join(shlex.quote(c) for c in cmd)}", verbose=self.verbose)
             return ""
         return run(cmd, capture=capture)
 
-    def _nvidia_settings(self, attr, value):
-        if not self.use_offsets:
+    def _nvidia_settings(self, assignments):
+        """Apply one or more attr=value assignments in a single nvidia-settings call."""
+        if not self.use_offsets or not assignments:
             return
-        if not which("nvidia-settings"):
+        if not self._nvset_path:
             sys.exit("ERROR: --core-offset/--memory-offset requires 'nvidia-settings' and Coolbits.")
-        if not self.display:
+        if self._nvset_env is None:
             sys.exit("ERROR: --display is required when using offsets via nvidia-settings (e.g., --display :0).")
-        env = os.environ.copy()
-        env["DISPLAY"] = self.display
-        cmd = ["nvidia-settings", "-a", f"[gpu:{self.index}]/{attr}={value}"]
+        cmd = [self._nvset_path]
+        for attr, value in assignments:
+            cmd += ["-a", f"[gpu:{self.index}]/{attr}={value}"]
         if self.dry_run:
-            log(f"[dry-run] DISPLAY={env['DISPLAY']} {' '.join(shlex.quote(c) for c in cmd)}", verbose=self.verbose)
+            log(f"[dry-run] DISPLAY={self.display} {' '.join(shlex.quote(c) for c in cmd)}", verbose=self.verbose)
             return
-        run(cmd, env=env)
+        run(cmd, env=self._nvset_env)
 
     # ---- Queries ----
 
     def query_basic(self):
         """
-        Return dict: clocks_gr (MHz), temp (C), power (W), util (%), pstate (e.g., P0)
+        Return a GpuInfo: clocks_gr (MHz), temp (C), power (W), util (%),
+        pstate (e.g., P0); None on failure.
+
+        The GpuInfo is owned by NvCtl and overwritten in place on the next
+        query; callers must not retain references across polls.
         """
-        fmt = "clocks.gr,temperature.gpu,power.draw,utilization.gpu,pstate"
-        out = self._nvidia_smi(["--query-gpu=" + fmt, "--format=csv,noheader,nounits"], capture=True)
+        if self._h is not None:
+            info = self._info
+            if self._fi_ids is not None:
+                try:
+                    vals = pynvml.nvmlDeviceGetFieldValues(self._h, self._fi_ids)
+                    if all(fv.nvmlReturn == pynvml.NVML_SUCCESS for fv in vals):
+                        clk, temp, power, util, pstate = (_nvml_field_value(fv) for fv in vals)
+                        info.clocks_gr = int(clk)
+                        info.temp = int(temp)
+                        info.power = power / 1000.0   # mW -> W
+                        info.util = int(util)
+                        info.pstate = f"P{int(pstate)}"
+                        return info
+                except pynvml.NVMLError:
+                    pass
+                # Driver rejects these field IDs; stop retrying every poll.
+                self._fi_ids = None
+            try:
+                info.clocks_gr = pynvml.nvmlDeviceGetClockInfo(self._h, pynvml.NVML_CLOCK_GRAPHICS)
+                info.temp = pynvml.nvmlDeviceGetTemperature(self._h, pynvml.NVML_TEMPERATURE_GPU)
+                info.power = pynvml.nvmlDeviceGetPowerUsage(self._h) / 1000.0
+                info.util = pynvml.nvmlDeviceGetUtilizationRates(self._h).gpu
+                info.pstate = f"P{pynvml.nvmlDeviceGetPerformanceState(self._h)}"
+                return info
+            except pynvml.NVMLError:
+                return None
+        out = self._nvidia_smi(["--query-gpu=" + self.BASIC_FIELDS, "--format=csv,noheader,nounits"], capture=True)
         if not out:
-            return {}
-        parts = [p.strip() for p in out.split(",")]
-        return {
-            "clocks_gr": int(float(parts[0])),
-            "temp": int(float(parts[1])),
-            "power": float(parts[2]),
-            "util": int(float(parts[3])),
-            "pstate": parts[4]
-        }
+            return None
+        return self.parse_basic(out)
+
+    # CSV field order shared by query_basic and the -lms stream reader.
+    BASIC_FIELDS = "clocks.gr,temperature.gpu,power.draw,utilization.gpu,pstate"
+
+    def parse_basic(self, line):
+        """Parse one CSV line (BASIC_FIELDS order) into the reused GpuInfo; None on bad input."""
+        parts = [p.strip() for p in line.split(",")]
+        info = self._info
+        try:
+            info.clocks_gr = int(float(parts[0]))
+            info.temp = int(float(parts[1]))
+            info.power = float(parts[2])
+            info.util = int(float(parts[3]))
+            info.pstate = parts[4]
+            return info
+        except (ValueError, IndexError):
+            return None
 
     def query_supported_gc(self):
         """
-        Return list of supported graphics clocks (MHz) if available.
+        Return the supported graphics clocks (MHz, sorted tuple) if
+        available. Queried once and memoized — the clock grid never changes
+        at runtime, so later calls (and per-lock snapping) are free.
         """
-        out = self._nvidia_smi(["--query-supported-clocks=gr", "--format=csv,noheader,nounits"], capture=True)
-        if not out:
-            return []
-        try:
-            vals = [int(v.strip()) for v in out.splitlines()]
-            vals.sort()
-            return vals
-        except Exception:
-            return []
+        if self._supported is None:
+            self._supported = ()
+            out = self._nvidia_smi(["--query-supported-clocks=gr", "--format=csv,noheader,nounits"], capture=True)
+            if out:
+                try:
+                    self._supported = tuple(sorted(int(v.strip()) for v in out.splitlines()))
+                except Exception:
+                    self._supported = ()
+        return self._supported
+
+    def snap_to_supported(self, mhz, supported=None):
+        """
+        Snap mhz to the nearest supported graphics clock (O(log n) bisect;
+        query_supported_gc returns a sorted list). Returns mhz unchanged if
+        the supported list is empty/unavailable.
+        """
+        sup = supported if supported is not None else self.query_supported_gc()
+        if not sup:
+            return mhz
+        i = bisect.bisect_left(sup, mhz)
+        lo = sup[max(i - 1, 0)]
+        hi = sup[min(i, len(sup) - 1)]
+        return lo if abs(lo - mhz) <= abs(hi - mhz) else hi
+
+    def _power_limit_range(self):
+        """
+        Return (min_w, max_w) power limit constraints, queried once and cached.
+        Returns (None, None) if they cannot be determined.
+        """
+        if self._pl_min is None:
+            try:
+                if self._h is not None:
+                    mn, mx = pynvml.nvmlDeviceGetPowerManagementLimitConstraints(self._h)
+                    self._pl_min, self._pl_max = mn / 1000.0, mx / 1000.0
+                else:
+                    out = self._nvidia_smi(["--query-gpu=power.min_limit,power.max_limit",
+                                            "--format=csv,noheader,nounits"], capture=True)
+                    self._pl_min, self._pl_max = [float(x.strip()) for x in out.split(",")]
+            except Exception:
+                return None, None
+        return self._pl_min, self._pl_max
 
     # ---- Settings ----
 
     def enable_persistence(self):
+        # Prefer the persistence daemon: it keeps the driver initialized for
+        # every later nvidia-smi/NVML call, unlike the legacy kernel-level
+        # '-pm 1' mode it replaced.
+        systemctl = which("systemctl")
+        if systemctl and not self.dry_run:
+            try:
+                state = run([systemctl, "is-active", "nvidia-persistenced"], check=False, capture=True)
+                if state == "active":
+                    return
+                run([systemctl, "start", "nvidia-persistenced"], capture=True)
+                return
+            except Exception:
+                pass  # unit missing or masked: fall back to legacy mode
         self._nvidia_smi(["-pm", "1"])
 
     def set_power_limit(self, watts):
-        # Check constraints (optional)
-        try:
-            out = self._nvidia_smi(["--query-gpu=power.limit,power.min_limit,power.max_limit",
-                                    "--format=csv,noheader,nounits"], capture=True)
-            cur, mn, mx = [float(x.strip()) for x in out.split(",")]
-            if not (mn <= watts <= mx):
-                log(f"WARNING: Requested power limit {watts}W not in [{mn},{mx}]W range. Clamping.", verbose=self.verbose)
-                watts = max(mn, min(mx, watts))
-        except Exception:
-            pass
+        # Clamp against the cached constraints; no extra subprocess per call.
+        mn, mx = self._power_limit_range()
+        if mn is not None and not (mn <= watts <= mx):
+            log(f"WARNING: Requested power limit {watts}W not in [{mn},{mx}]W range. Clamping.", verbose=self.verbose)
+            watts = max(mn, min(mx, watts))
+        if self._h is not None:
+            try:
+                pynvml.nvmlDeviceSetPowerManagementLimit(self._h, int(watts) * 1000)
+                return
+            except pynvml.NVMLError:
+                pass  # fall through to nvidia-smi
         self._nvidia_smi(["-pl", str(int(watts))])
 
     def lock_graphics_clock(self, min_mhz, max_mhz):
+        # Snap to the supported grid (if known) so the driver never has to
+        # silently round an off-grid value.
+        if self._supported:
+            max_mhz = self.snap_to_supported(int(max_mhz), self._supported)
+        if self._h is not None:
+            try:
+                pynvml.nvmlDeviceSetGpuLockedClocks(self._h, int(min_mhz), int(max_mhz))
+                return
+            except pynvml.NVMLError:
+                pass  # older drivers: only the -lgc CLI path works
         self._nvidia_smi(["-lgc", f"{int(min_mhz)},{int(max_mhz)}"])
 
+    def ramp_lock_graphics_clock(self, min_mhz, steps, sleep_s, stop=None):
+        """
+        Lock the max clock to each value in `steps` in turn, sleeping sleep_s
+        between them. On NVML each set is a cheap C call; on the CLI path the
+        whole ramp is coalesced into one bash invocation so driver/library
+        init is paid once instead of per step. `stop` is an optional callable
+        checked between NVML steps (and while babysitting the CLI chain) to
+        abort the ramp early.
+        """
+        if not steps:
+            return
+        if self._supported:
+            # Snap each step to the grid, dropping duplicates it creates.
+            steps = list(dict.fromkeys(self.snap_to_supported(int(s), self._supported) for s in steps))
+        if self._h is not None:
+            try:
+                for s in steps:
+                    if stop is not None and stop():
+                        return
+                    pynvml.nvmlDeviceSetGpuLockedClocks(self._h, int(min_mhz), int(s))
+                    if s != steps[-1]:
+                        time.sleep(sleep_s)
+                return
+            except pynvml.NVMLError:
+                pass  # fall back to the coalesced CLI ramp
+        cmd_str = f" ; sleep {sleep_s} ; ".join(f"{self._lgc_sh_prefix} {int(min_mhz)},{int(s)}"
+                                                for s in steps)
+        if self.dry_run:
+            log(f"[dry-run] bash -c {shlex.quote(cmd_str)}", verbose=self.verbose)
+            return
+        proc = subprocess.Popen(["bash", "-c", cmd_str])
+        while True:
+            try:
+                proc.wait(timeout=0.1)
+                return
+            except subprocess.TimeoutExpired:
+                if stop is not None and stop():
+                    proc.terminate()
+                    proc.wait()
+                    return
+
     def unlock_graphics_clock(self):
+        if self._h is not None:
+            try:
+                pynvml.nvmlDeviceResetGpuLockedClocks(self._h)
+                return
+            except pynvml.NVMLError:
+                pass
         self._nvidia_smi(["-rgc"])
 
-    def set_core_offset(self, offset_mhz):
+    def apply_offsets(self, core=None, mem=None):
         # Apply across all performance levels; daemon only enables during load.
-        self._nvidia_settings("GPUGraphicsClockOffsetAllPerformanceLevels", str(int(offset_mhz)))
+        # Both offsets go out in one nvidia-settings invocation (one fork).
+        assignments = []
+        if core is not None:
+            assignments.append(("GPUGraphicsClockOffsetAllPerformanceLevels", str(int(core))))
+        if mem is not None:
+            assignments.append(("GPUMemoryTransferRateOffsetAllPerformanceLevels", str(int(mem))))
+        self._nvidia_settings(assignments)
+
+    def set_core_offset(self, offset_mhz):
+        self.apply_offsets(core=offset_mhz)
 
     def reset_core_offset(self):
-        self._nvidia_settings("GPUGraphicsClockOffsetAllPerformanceLevels", "0")
+        self.apply_offsets(core=0)
 
     def set_mem_offset(self, offset_mhz):
-        self._nvidia_settings("GPUMemoryTransferRateOffsetAllPerformanceLevels", str(int(offset_mhz)))
+        self.apply_offsets(mem=offset_mhz)
 
     def reset_mem_offset(self):
-        self._nvidia_settings("GPUMemoryTransferRateOffsetAllPerformanceLevels", "0")
+        self.apply_offsets(mem=0)
 
 
 # ---------- Daemon Loop ----------
@@ -171,9 +531,14 @@ class UndervoltDaemon:
     def __init__(self, nv: NvCtl, target_clock, transition_clock,
                  min_clock=210, core_offset=0, mem_offset=0, power_limit=None,
                  temp_limit=None, poll=0.5, on_hold=1.0, off_hold=2.0,
-                 ramp=False, ramp_step=15, ramp_sleep=0.2, verbose=True):
+                 ramp=False, ramp_step=15, ramp_sleep=0.2, smi_stream=False, verbose=True):
         self.nv = nv
         self.target_clock = int(target_clock)
+        # Thermal guard bookkeeping: remember the user's target so we can
+        # ramp back up after transient thermal events, rate-limited.
+        self._target_clock_user = self.target_clock
+        self.temp_hysteresis = 5  # °C below limit before stepping back up
+        self._last_guard_step_ns = 0
         self.transition_clock = int(transition_clock)
         self.min_clock = int(min_clock)
         self.core_offset = int(core_offset)
@@ -181,56 +546,77 @@ class UndervoltDaemon:
         self.power_limit = int(power_limit) if power_limit else None
         self.temp_limit = int(temp_limit) if temp_limit else None
         self.poll = float(poll)
+        # Step back up at most once per 10 polls so the guard cannot flap.
+        self._guard_recover_ns = int(self.poll * 10 * 1e9)
         self.on_hold = float(on_hold)
         self.off_hold = float(off_hold)
+        self._on_hold_ns = int(self.on_hold * 1e9)
+        self._off_hold_ns = int(self.off_hold * 1e9)
         self.ramp = bool(ramp)
         self.ramp_step = int(ramp_step)
         self.ramp_sleep = float(ramp_sleep)
+        self.smi_stream = bool(smi_stream)
         self.verbose = verbose
 
+        self._smi_proc = None
+        self._use_events = False
+
         self.active = False
-        self.last_above_ts = 0.0
-        self.last_below_ts = now()
+        self.last_above_ns = 0
+        self.last_below_ns = now_ns()
 
-        self._stop = False
+        self._stop_event = asyncio.Event()
 
-    def _handle_sig(self, signum, frame):
-        log(f"\n[daemon] Caught signal {signum}, reverting...", verbose=True)
+    async def _sleep(self, seconds):
+        """Sleep up to `seconds`, waking immediately on a stop signal.
+        Returns True if stop was requested."""
         try:
-            self.revert()
-        finally:
-            self._stop = True
-
-    def apply_active(self):
+            await asyncio.wait_for(self._stop_event.wait(), timeout=seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def apply_active(self):
+        # Transition-time calls can fork (nvidia-settings, CLI fallback);
+        # run them in threads so other GPUs' loops and signals keep moving.
         # Apply offsets (requires X/Coolbits) first, then lock clocks.
-        if self.nv.use_offsets and self.core_offset:
-            log(f"[daemon] Applying core offset: +{self.core_offset} MHz", verbose=self.verbose)
-            self.nv.set_core_offset(self.core_offset)
-        if self.nv.use_offsets and self.mem_offset:
-            log(f"[daemon] Applying memory offset: +{self.mem_offset} MHz", verbose=self.verbose)
-            self.nv.set_mem_offset(self.mem_offset)
+        if self.nv.use_offsets and (self.core_offset or self.mem_offset):
+            log(f"[daemon] Applying offsets: core=+{self.core_offset} mem=+{self.mem_offset} MHz", verbose=self.verbose)
+            await asyncio.to_thread(self.nv.apply_offsets,
+                                    self.core_offset if self.core_offset else None,
+                                    self.mem_offset if self.mem_offset else None)
 
         # Optional power cap (one-time)
         if self.power_limit:
             log(f"[daemon] Setting power limit: {self.power_limit} W", verbose=self.verbose)
-            self.nv.set_power_limit(self.power_limit)
+            await asyncio.to_thread(self.nv.set_power_limit, self.power_limit)
 
         # Lock graphics clock
         if self.ramp:
-            # Ramp up max from transition to target in steps
+            # Ramp up max from transition to target in steps; the whole ramp
+            # runs in one NvCtl call (single subprocess on the CLI path).
+            steps = []
             current = max(self.transition_clock, self.min_clock)
-            while current < self.target_clock and not self._stop:
-                step_to = min(current + self.ramp_step, self.target_clock)
-                log(f"[daemon] Lock ramp -> {step_to} MHz", verbose=self.verbose)
-                self.nv.lock_graphics_clock(self.min_clock, step_to)
-                time.sleep(self.ramp_sleep)
-                current = step_to
+            while current < self.target_clock:
+                current = min(current + self.ramp_step, self.target_clock)
+                steps.append(current)
+            if steps:
+                log(f"[daemon] Lock ramp -> {steps[-1]} MHz ({len(steps)} steps)", verbose=self.verbose)
+                await asyncio.to_thread(self.nv.ramp_lock_graphics_clock,
+                                        self.min_clock, steps, self.ramp_sleep,
+                                        self._stop_event.is_set)
         log(f"[daemon] Locking clocks min={self.min_clock} max={self.target_clock} MHz", verbose=self.verbose)
-        self.nv.lock_graphics_clock(self.min_clock, self.target_clock)
+        await asyncio.to_thread(self.nv.lock_graphics_clock, self.min_clock, self.target_clock)
 
         self.active = True
 
     def revert(self):
+        # Dry-run: one summary line instead of replaying every would-be
+        # command again (the apply side already printed them).
+        if self.nv.dry_run:
+            log("[daemon] (dry-run) would unlock clocks and reset offsets", verbose=self.verbose)
+            self.active = False
+            return
         # Unlock and reset offsets
         try:
             self.nv.unlock_graphics_clock()
@@ -238,79 +624,181 @@ class UndervoltDaemon:
             log(f"[daemon] unlock_graphics_clock: {e}", verbose=self.verbose)
         if self.nv.use_offsets:
             try:
-                if self.core_offset:
-                    self.nv.reset_core_offset()
-                if self.mem_offset:
-                    self.nv.reset_mem_offset()
+                self.nv.apply_offsets(core=0 if self.core_offset else None,
+                                      mem=0 if self.mem_offset else None)
             except Exception as e:
                 log(f"[daemon] reset offsets: {e}", verbose=self.verbose)
         self.active = False
 
+    def _start_smi_stream(self):
+        # One long-lived reader: nvidia-smi paces its own output via -lms, so
+        # we pay driver/library init once instead of once per poll.
+        cmd = [self.nv._nvsmi_path, "-i", str(self.nv.index),
+               "--query-gpu=" + NvCtl.BASIC_FIELDS, "--format=csv,noheader,nounits",
+               "-lms", str(max(int(self.poll * 1000), 100))]
+        self._smi_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, bufsize=1)
+        log(f"[daemon] Started persistent nvidia-smi reader (pid {self._smi_proc.pid})", verbose=self.verbose)
+
+    def _stop_smi_stream(self):
+        # Reap the child (it can die mid-run while the daemon keeps going,
+        # which would otherwise leave a zombie) and close its pipe.
+        if self._smi_proc is not None:
+            proc, self._smi_proc = self._smi_proc, None
+            proc.terminate()
+            try:
+                proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            if proc.stdout:
+                proc.stdout.close()
+
+    async def _next_info(self):
+        """Fetch the next sample: blocking readline from the -lms stream if
+        enabled, else a plain query plus a poll sleep."""
+        if self._smi_proc is not None:
+            line = await asyncio.to_thread(self._smi_proc.stdout.readline)
+            if not line:
+                # Reader died; fall back to per-poll queries.
+                log("[daemon] nvidia-smi reader exited, falling back to polling", verbose=self.verbose)
+                self._stop_smi_stream()
+                return await asyncio.to_thread(self.nv.query_basic)
+            return self.nv.parse_basic(line)
+        if self.nv.using_nvml:
+            # Microsecond C calls; not worth a thread hop.
+            return self.nv.query_basic()
+        # CLI fallback forks nvidia-smi: keep the blocking run() off the
+        # shared event loop so multi-GPU polls overlap and signals land.
+        return await asyncio.to_thread(self.nv.query_basic)
+
     def thermal_guard(self):
         if not self.temp_limit or not self.active:
             return
-        info = self.nv.query_basic()
-        if not info:
+        temp, reasons = self.nv.query_thermal()
+        if temp is None:
             return
-        if info["temp"] > self.temp_limit:
+        # Step down on over-temp, or pre-emptively when the driver already
+        # reports a thermal/HW slowdown (throttle bits via DCGM).
+        if temp > self.temp_limit or (reasons & THERMAL_THROTTLE_MASK):
             # Drop max by one step
             new_max = max(self.min_clock, self.target_clock - self.ramp_step)
             if new_max < self.target_clock:
-                log(f"[daemon] Temp {info['temp']}°C > {self.temp_limit}°C, reducing max to {new_max} MHz", verbose=self.verbose)
+                why = f"temp {temp}°C > {self.temp_limit}°C" if temp > self.temp_limit else f"throttle reasons 0x{reasons:x}"
+                log(f"[daemon] Thermal guard ({why}), reducing max to {new_max} MHz", verbose=self.verbose)
                 self.target_clock = new_max
                 self.nv.lock_graphics_clock(self.min_clock, self.target_clock)
+            self._last_guard_step_ns = now_ns()
+        elif (self.target_clock < self._target_clock_user
+              and temp < self.temp_limit - self.temp_hysteresis):
+            # Temp recovered with margin: ramp back toward the user's target,
+            # one step at a time and rate-limited so the guard cannot flap.
+            t = now_ns()
+            if (t - self._last_guard_step_ns) >= self._guard_recover_ns:
+                new_max = min(self._target_clock_user, self.target_clock + self.ramp_step)
+                log(f"[daemon] Temp {temp}°C recovered, raising max to {new_max} MHz", verbose=self.verbose)
+                self.target_clock = new_max
+                self.nv.lock_graphics_clock(self.min_clock, self.target_clock)
+                self._last_guard_step_ns = t
 
-    def run(self):
-        signal.signal(signal.SIGINT, self._handle_sig)
-        signal.signal(signal.SIGTERM, self._handle_sig)
-
-        log(f"[daemon] Starting (v{VERSION})...", verbose=self.verbose)
+    async def run(self):
+        log(f"[daemon] Starting for GPU {self.nv.index} (v{VERSION})...", verbose=self.verbose)
         # Enable persistence for reliability
         try:
             self.nv.enable_persistence()
         except Exception as e:
             log(f"[daemon] persistence warn: {e}", verbose=self.verbose)
 
+        # Opt-in: persistent reader keeps the GPU awake, so it is off by
+        # default (PRIME/on-demand laptops). Pointless when NVML is in use.
+        if self.smi_stream and not self.nv.using_nvml and not self.nv.dry_run:
+            try:
+                self._start_smi_stream()
+            except Exception as e:
+                log(f"[daemon] smi-stream warn: {e}", verbose=self.verbose)
+
+        # Event-driven wakeups (NVML): sleep inside the driver and wake
+        # immediately on pstate/clock changes instead of always waiting out
+        # the poll interval. Idle cost drops; transitions are seen at once.
+        self._use_events = self.nv.watch_events()
+        if self._use_events:
+            log("[daemon] Using NVML clock/pstate events for wakeups", verbose=self.verbose)
+
         try:
-            while not self._stop:
-                info = self.nv.query_basic()
+            while not self._stop_event.is_set():
+                info = await self._next_info()
                 if not info:
-                    time.sleep(self.poll)
+                    await self._sleep(self.poll)
                     continue
 
-                clk = info["clocks_gr"]
+                clk = info.clocks_gr
 
                 # Hysteresis timers
-                t = now()
+                t = now_ns()
                 if clk >= self.transition_clock:
-                    if self.last_above_ts == 0:
-                        self.last_above_ts = t
+                    if self.last_above_ns == 0:
+                        self.last_above_ns = t
                     # Enough sustained?
-                    if (t - self.last_above_ts) >= self.on_hold and not self.active:
+                    if (t - self.last_above_ns) >= self._on_hold_ns and not self.active:
                         log(f"[daemon] Enabling undervolt (clk={clk} MHz)", verbose=self.verbose)
-                        self.apply_active()
+                        await self.apply_active()
                     # Reset below timer
-                    self.last_below_ts = t
+                    self.last_below_ns = t
                 else:
-                    if self.last_below_ts == 0:
-                        self.last_below_ts = t
+                    if self.last_below_ns == 0:
+                        self.last_below_ns = t
                     # Enough sustained below?
-                    if (t - self.last_below_ts) >= self.off_hold and self.active:
+                    if (t - self.last_below_ns) >= self._off_hold_ns and self.active:
                         log(f"[daemon] Disabling undervolt (clk={clk} MHz)", verbose=self.verbose)
-                        self.revert()
+                        await asyncio.to_thread(self.revert)
                     # Reset above timer
-                    self.last_above_ts = t
+                    self.last_above_ns = t
 
-                # Thermal guard (only when active)
-                self.thermal_guard()
-
-                time.sleep(self.poll)
+                # Thermal guard (only when active); the guard can fork on
+                # the CLI fallback, so keep it off the loop there too.
+                if self.nv.using_nvml:
+                    self.thermal_guard()
+                else:
+                    await asyncio.to_thread(self.thermal_guard)
+
+                # The -lms child paces the loop; only sleep when polling.
+                if self._smi_proc is None:
+                    if self._use_events:
+                        # Returns early on a clock/pstate event, else acts as
+                        # the normal poll tick (thermal guard cadence).
+                        await asyncio.to_thread(self.nv.wait_event, int(self.poll * 1000))
+                        if not self.nv.events_active:
+                            # Event set died (GPU lost/driver reload): go
+                            # back to sleep ticks instead of spinning.
+                            log("[daemon] NVML events lost, falling back to sleep ticks", verbose=self.verbose)
+                            self._use_events = False
+                    else:
+                        await self._sleep(self.poll)
         finally:
             # Ensure clean revert on any exit
+            self._stop_smi_stream()
             self.revert()
+            self.nv.close()
             log("[daemon] Stopped.", verbose=True)
 
 
+async def run_daemons(daemons):
+    """
+    Drive one or more per-GPU daemons on a single event loop. One process
+    handles every GPU: signals are registered once and fan out to each
+    daemon's stop event.
+    """
+    loop = asyncio.get_running_loop()
+
+    def _stop_all(signum):
+        log(f"\n[daemon] Caught signal {signum}, stopping...", verbose=True)
+        for d in daemons:
+            d._stop_event.set()
+
+    loop.add_signal_handler(signal.SIGINT, _stop_all, signal.SIGINT)
+    loop.add_signal_handler(signal.SIGTERM, _stop_all, signal.SIGTERM)
+    await asyncio.gather(*(d.run() for d in daemons))
+
+
 # ---------- One-shot ----------
 
 def oneshot(nv: NvCtl, min_clock, target_clock, core_offset, mem_offset, power_limit, verify, verbose):
@@ -328,12 +816,10 @@ def oneshot(nv: NvCtl, min_clock, target_clock, core_offset, mem_offset, power_l
         nv.set_power_limit(power_limit)
 
     # Offsets (if requested)
-    if nv.use_offsets and core_offset:
-        log(f"[oneshot] Applying core offset: +{core_offset} MHz", verbose=verbose)
-        nv.set_core_offset(core_offset)
-    if nv.use_offsets and mem_offset:
-        log(f"[oneshot] Applying memory offset: +{mem_offset} MHz", verbose=verbose)
-        nv.set_mem_offset(mem_offset)
+    if nv.use_offsets and (core_offset or mem_offset):
+        log(f"[oneshot] Applying offsets: core=+{core_offset} mem=+{mem_offset} MHz", verbose=verbose)
+        nv.apply_offsets(core=core_offset if core_offset else None,
+                         mem=mem_offset if mem_offset else None)
 
     # Lock clocks
     log(f"[oneshot] Locking clocks min={min_clock} max={target_clock} MHz", verbose=verbose)
@@ -342,18 +828,49 @@ def oneshot(nv: NvCtl, min_clock, target_clock, core_offset, mem_offset, power_l
     if verify:
         time.sleep(0.5)
         info = nv.query_basic()
-        log(f"[oneshot] Now: clk={info.get('clocks_gr','?')} MHz, temp={info.get('temp','?')}C, power={info.get('power','?')}W, pstate={info.get('pstate','?')}", verbose=verbose)
+        if info:
+            log(f"[oneshot] Now: clk={info.clocks_gr} MHz, temp={info.temp}C, power={info.power}W, pstate={info.pstate}", verbose=verbose)
+        else:
+            log("[oneshot] Status query failed.", verbose=verbose)
 
     # Note: In one-shot we do NOT revert on exit (it is set-and-forget).
+    nv.close()
     log("[oneshot] Done. Settings persist until reboot or manual revert.", verbose=verbose)
 
 
 # ---------- CLI ----------
 
+def parse_indices(spec):
+    """
+    Parse --index: a single index, a comma-separated list ('0,2,3'), or
+    'all' (every GPU on the system, counted via NVML or nvidia-smi).
+    """
+    if spec.strip().lower() == "all":
+        if pynvml is not None:
+            try:
+                pynvml.nvmlInit()
+                try:
+                    return list(range(pynvml.nvmlDeviceGetCount()))
+                finally:
+                    pynvml.nvmlShutdown()
+            except pynvml.NVMLError:
+                pass
+        try:
+            out = run([which("nvidia-smi") or "nvidia-smi",
+                       "--query-gpu=count", "--format=csv,noheader"], capture=True)
+            return list(range(int(out.splitlines()[0])))
+        except Exception:
+            sys.exit("ERROR: Could not enumerate GPUs for --index all.")
+    try:
+        return sorted({int(p) for p in spec.split(",")})
+    except ValueError:
+        sys.exit(f"ERROR: Invalid --index '{spec}' (use N, N,M,..., or 'all').")
+
+
 def main():
     parser = argparse.ArgumentParser(description="NVIDIA GPU undervolt / efficiency tool (one-shot or daemon).")
     parser.add_argument("--version", action="version", version=f"%(prog)s {VERSION}")
-    parser.add_argument("--index", type=int, default=0, help="GPU index (default: 0)")
+    parser.add_argument("--index", type=str, default="0", help="GPU index, comma-separated list (0,1,2), or 'all' (default: 0)")
     parser.add_argument("--display", type=str, default=None, help="X DISPLAY for nvidia-settings (e.g., :0). Required if using offsets.")
     parser.add_argument("--mode", choices=["oneshot", "daemon"], default="daemon", help="Run as one-shot or daemon (default: daemon)")
     parser.add_argument("--min-clock", type=int, default=210, help="Locked min graphics clock MHz (default: 210)")
@@ -369,6 +886,7 @@ def main():
     parser.add_argument("--ramp", action="store_true", help="Daemon: ramp max clock in steps instead of jumping")
     parser.add_argument("--ramp-step", type=int, default=15, help="Daemon: ramp step MHz (default: 15)")
     parser.add_argument("--ramp-sleep", type=float, default=0.2, help="Daemon: sleep between ramp steps seconds (default: 0.2)")
+    parser.add_argument("--smi-stream", action="store_true", help="Daemon: keep one persistent nvidia-smi reader instead of forking per poll (keeps GPU awake; avoid on PRIME laptops)")
     parser.add_argument("--use-offsets", action="store_true", help="Enable using nvidia-settings for core/mem offsets")
     parser.add_argument("--dry-run", action="store_true", help="Print commands only; do not apply changes")
     parser.add_argument("--verify", action="store_true", help="One-shot: print status after applying")
@@ -383,26 +901,31 @@ def main():
             sys.exit("ERROR: --display is required with --use-offsets (e.g., --display :0)")
 
     verbose = not args.quiet
-    nv = NvCtl(index=args.index, display=args.display, use_offsets=args.use_offsets,
-               dry_run=args.dry_run, verbose=verbose)
+    indices = parse_indices(args.index)
+    nvs = [NvCtl(index=i, display=args.display, use_offsets=args.use_offsets,
+                 dry_run=args.dry_run, verbose=verbose) for i in indices]
 
     # Default transition threshold
     transition_clock = args.transition_clock if args.transition_clock is not None else max(args.target_clock - 300, args.min_clock)
 
     # Sanity: Check target in supported clocks (best-effort)
-    try:
-        sup = nv.query_supported_gc()
-        if sup and args.target_clock not in sup:
-            # Suggest nearest valid step (usually 15MHz grid)
-            nearest = min(sup, key=lambda x: abs(x - args.target_clock))
-            log(f"WARNING: {args.target_clock} MHz not in supported list; nearest is {nearest} MHz", verbose=verbose)
-    except Exception:
-        pass
+    for nv in nvs:
+        try:
+            sup = nv.query_supported_gc()
+            if sup and args.target_clock not in sup:
+                # Suggest nearest valid step (usually 15MHz grid)
+                nearest = nv.snap_to_supported(args.target_clock, sup)
+                log(f"WARNING: GPU {nv.index}: {args.target_clock} MHz not in supported list; nearest is {nearest} MHz", verbose=verbose)
+        except Exception:
+            pass
 
     if args.mode == "oneshot":
-        oneshot(nv, args.min_clock, args.target_clock, args.core_offset, args.memory_offset, args.power_limit, args.verify, verbose)
+        for nv in nvs:
+            oneshot(nv, args.min_clock, args.target_clock, args.core_offset, args.memory_offset, args.power_limit, args.verify, verbose)
     else:
-        daemon = UndervoltDaemon(
+        # One process, one event loop: a daemon state per GPU, no per-GPU
+        # Python processes fighting over the driver.
+        daemons = [UndervoltDaemon(
             nv=nv,
             target_clock=args.target_clock,
             transition_clock=transition_clock,
@@ -417,9 +940,10 @@ def main():
             ramp=args.ramp,
             ramp_step=args.ramp_step,
             ramp_sleep=args.ramp_sleep,
+            smi_stream=args.smi_stream,
             verbose=verbose,
-        )
-        daemon.run()
+        ) for nv in nvs]
+        asyncio.run(run_daemons(daemons))
 
 
 if __name__ == "__main__":